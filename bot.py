@@ -28,10 +28,15 @@ Environment variables required:
 - MNIT_API_KEY     -> Provider API key
 Optional:
 - FORWARD_CHAT_ID  -> group id to forward OTPs to (default -1003379113224)
-- POLL_INTERVAL    -> seconds between polling attempts (default 10)
+- POLL_INTERVAL    -> seconds between provider /info sweeps (default 10); Telegram updates
+                      use long polling and are not affected
+- MAX_POLL_INTERVAL -> upper bound for the idle polling backoff in seconds (default 60)
 - DISCOVER_PAGES   -> pages to scan when discovering prefixes/countries (default 6)
 - MAX_ALLOC_PER_COUNTRY -> max numbers to allocate per country (default 3)
 - ENABLE_DEBUG_TO_CHAT  -> chat id (string) to receive debug messages (optional)
+- WEBHOOK_URL      -> public https base URL; when set, Telegram pushes updates to
+                      <WEBHOOK_URL>/<token> instead of the bot long-polling getUpdates
+- PORT             -> port the webhook server listens on (default 8443)
 """
 
 from __future__ import annotations
@@ -40,13 +45,21 @@ import os
 import re
 import json
 import time
+import random
+import signal
 import logging
 import html
 import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Set, Callable
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telegram import (
     Bot,
     Update,
@@ -63,7 +76,23 @@ from telegram.ext import (
     MessageHandler,
     Filters,
 )
-from telegram.error import Unauthorized, NetworkError, Conflict
+from telegram.error import Unauthorized, NetworkError, Conflict, RetryAfter
+from telegram.utils.request import Request
+
+try:
+    import orjson  # optional: faster JSON for state.json and provider responses
+except ImportError:
+    orjson = None
+
+try:
+    import re2  # optional (google-re2): linear-time automaton for the OTP scan
+except ImportError:
+    re2 = None
+
+try:
+    import ahocorasick  # optional (pyahocorasick): multi-pattern matching in the poll sweep
+except ImportError:
+    ahocorasick = None
 
 # -----------------------------
 # Configuration (from env)
@@ -71,27 +100,98 @@ from telegram.error import Unauthorized, NetworkError, Conflict
 MNIT_API_KEY = os.getenv("MNIT_API_KEY", "M_WH9Q3U88V").strip()
 FORWARD_CHAT_ID = int(os.getenv("FORWARD_CHAT_ID", "-1003379113224"))
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "10"))
+MAX_POLL_INTERVAL = int(os.getenv("MAX_POLL_INTERVAL", "60"))
+INFO_CACHE_TTL = max(1, POLL_INTERVAL // 2)  # seconds an /info page is shared between callers
+DISCOVER_CACHE_TTL = 60  # seconds a service's country/prefix scan is reused
 DISCOVER_PAGES = int(os.getenv("DISCOVER_PAGES", "6"))
 MAX_ALLOC_PER_COUNTRY = int(os.getenv("MAX_ALLOC_PER_COUNTRY", "3"))
+MIN_MATCH_DIGITS = 6  # shortest provider number accepted as a suffix match for an allocation
 ENABLE_DEBUG_TO_CHAT = os.getenv("ENABLE_DEBUG_TO_CHAT")  # optional admin chat id
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+PORT = int(os.getenv("PORT", "8443"))
 
 # Provider endpoints
 ALLOCATE_URL = "https://x.mnitnetwork.com/mapi/v1/mdashboard/getnum/number"
 INFO_URL = "https://x.mnitnetwork.com/mapi/v1/mdashboard/getnum/info"
 HEADERS = {"Content-Type": "application/json", "mapikey": MNIT_API_KEY}
 
+PROVIDER_MAX_RETRY_AFTER = 5  # seconds; cap on a provider Retry-After so HTTP_POOL workers aren't parked
+
+
+class CappedRetry(Retry):
+    """urllib3 Retry that honours Retry-After only up to PROVIDER_MAX_RETRY_AFTER seconds."""
+
+    def get_retry_after(self, response: Any) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, PROVIDER_MAX_RETRY_AFTER)
+
+
+# One keep-alive session shared by every provider call (polling, discovery, allocation)
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+# idempotent GETs retry transient/rate-limit errors (honouring a capped Retry-After); allocation POSTs are never retried
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=CappedRetry(total=2, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504], raise_on_status=False),
+))
+# Bounded fan-out for provider calls (kept under the session pool size and provider rate limits)
+HTTP_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="http")
+
 # -----------------------------
 # UI text & constants
 # -----------------------------
 CARD_SEPARATOR = "━━━━━━━━━━━━━━━━━━━━━━━━━━"
+TELEGRAM_TEXT_LIMIT = 4096  # max length of one message after HTML parsing
 SERVICES = ["WhatsApp", "Facebook", "Instagram", "Other"]
 MAIN_REPLY_KEYS = [
     ["📲 Get Number", "📥 Active"],
     ["📜 History", "⚙ Settings"],
 ]
+# keyboards that never change are built once and reused
+MAIN_REPLY_MARKUP = ReplyKeyboardMarkup(MAIN_REPLY_KEYS, resize_keyboard=True, one_time_keyboard=False)
+SERVICE_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(svc, callback_data=f"svc|{svc}")] for svc in SERVICES]
+    + [[InlineKeyboardButton("Cancel", callback_data="cancel")]]
+)
 MSG_HELPER = "Tip: Use /get to request numbers interactively."
 MSG_COPY_CONFIRM = "✅ Sent — long-press to copy."
+# settings come from the environment and never change at runtime
+SETTINGS_TEXT = (
+    "Settings:\n"
+    f"- Poll interval: {POLL_INTERVAL}s\n"
+    f"- Discover pages: {DISCOVER_PAGES}\n"
+    f"- Max alloc per country: {MAX_ALLOC_PER_COUNTRY}\n\n"
+    "Use environment variables to change settings and restart the service."
+)
 STATE_FILE = "state.json"
+HISTORY_LIMIT = 200  # finished allocations kept per chat
+STATE_LOG = "state.log"  # append-only journal of allocation changes since the last snapshot
+STATE_LOG_OLD = STATE_LOG + ".1"  # journal generation being folded into the next snapshot
+STATE_COMPACT_INTERVAL = 300  # seconds between folding the journal into state.json
+
+# Patterns used on the polling hot path; compiled once at import.
+_NON_DIGIT = re.compile(r"\D")
+_KEEP_DIGITS = str.maketrans("", "", "".join(chr(c) for c in range(128) if not chr(c).isdigit()))
+_SEP = re.compile(r"[|:]+")
+_EXPIRED_KEYS = ("expired", "failed")
+# service keywords; short aliases must stand alone so "wa" does not match "was"/"wait".
+# "Other" matches generic OTP mentions.
+_SERVICE_PATTERNS = {
+    "whatsapp": re.compile(r"whatsapp|\bwa\b", re.IGNORECASE),
+    "instagram": re.compile(r"instagram|insta|\big\b", re.IGNORECASE),
+    "facebook": re.compile(r"facebook|\bfb\b", re.IGNORECASE),
+    "other": re.compile(r"otp|code", re.IGNORECASE),
+}
+_KNOWN_MSG_KEYS = ("message", "sms", "msg", "text", "body", "sms_text", "content", "raw")
+_DEEP_MSG_KEYS = frozenset(("message", "sms", "msg", "text", "body", "content", "description"))
+# one scan for both OTP shapes: "<#> 123456"-style tagged codes, or a bare 4-8 digit number
+_OTP_PATTERN = r"[<#>]{1,3}\s*(?P<tag>\d{4,8})\b|\b(?P<num>\d{4,8})\b"
+_OTP_ANY = (re2 or re).compile(_OTP_PATTERN)
+# the same OTP shapes plus the expiry keywords, so a matched SMS is scanned once for both
+_OTP_OR_EXPIRED = (re2 or re).compile(_OTP_PATTERN + r"|(?P<expired>(?i:expired|failed))")
 
 # -----------------------------
 # Logging
@@ -105,45 +205,169 @@ logger = logging.getLogger(__name__)
 # state example:
 # {
 #   "<chat_id>": {
-#       "allocations": [
-#           {
+#       "allocations": {
+#           "1611111111111_0": {
 #               "id": "1611111111111_0",
 #               "range": "236724XXX",
 #               "number": "23672441234",
 #               "digits": "23672441234",
+#               "last_variants": ["441234", "7441234", ...],
 #               "country": "Central African Republic",
 #               "allocated_at": 1611111111,
 #               "status": "pending"|"success"|"expired",
 #               "otp": null or "123456"
 #           }, ...
-#       ],
-#       "history": [ ... ]  # optional archive of past allocations
+#       },
+#       "history": [ ... ]  # last HISTORY_LIMIT finished allocations (a deque in memory)
 #   }
 # }
 state: Dict[str, Dict[str, Any]] = {}
-jobs_registry: Dict[str, Any] = {}  # key = "<chat_id>:<alloc_id>" -> job handle
+# guards every mutation of state (handler threads, the sweep job) and the snapshot dump
+_state_lock = threading.RLock()
 
 # -----------------------------
 # Persistence helpers
 # -----------------------------
+def json_loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def json_dumps(obj: Any) -> bytes:
+    # default=list: per-chat history is a deque
+    return orjson.dumps(obj, default=list) if orjson else json.dumps(obj, default=list).encode("utf-8")
+
+
+def _apply_delta(delta: Dict[str, Any]) -> None:
+    """Replay one journal line onto state; idempotent so a line already in the snapshot is harmless."""
+    op = delta.get("op")
+    chat_id = str(delta.get("chat"))
+    alloc = delta.get("alloc") or {}
+    chat = state.setdefault(chat_id, {"allocations": {}, "history": deque(maxlen=HISTORY_LIMIT)})
+    allocs = chat["allocations"]
+    history = chat["history"]
+    if op == "add":
+        if alloc.get("id") not in allocs and not any(h.get("id") == alloc.get("id") for h in history):
+            allocs[alloc.get("id")] = alloc
+    elif op == "finish":
+        allocs.pop(alloc.get("id"), None)
+        if not any(h.get("id") == alloc.get("id") for h in history):
+            history.append(alloc)
+
+
 def load_state() -> None:
+    """Load the state.json snapshot, then replay the state.log journal written since."""
     global state
     try:
         if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, "r") as f:
-                state = json.load(f)
-            logger.info("Loaded state for %d chats", len(state))
+            with open(STATE_FILE, "rb") as f:
+                state = json_loads(f.read())
+        for chat_data in state.values():
+            # allocations used to be a list; they are keyed by id now
+            allocs = chat_data.get("allocations") or {}
+            if isinstance(allocs, list):
+                allocs = {a.get("id"): a for a in allocs}
+            chat_data["allocations"] = allocs
+            chat_data["history"] = deque(chat_data.get("history") or (), maxlen=HISTORY_LIMIT)
+        replayed = 0
+        # the older generation is left behind if a compaction didn't finish
+        for path in (STATE_LOG_OLD, STATE_LOG):
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        delta = json_loads(line)
+                    except Exception:
+                        continue  # torn last line after a crash
+                    _apply_delta(delta)
+                    replayed += 1
+        # allocations saved before last_variants existed
+        for chat_data in state.values():
+            for a in chat_data.get("allocations", {}).values():
+                if "last_variants" not in a:
+                    a["last_variants"] = list(last_n_variants(a.get("digits") or ""))
+        logger.info("Loaded state for %d chats (%d journal entries)", len(state), replayed)
     except Exception as e:
         logger.warning("Could not load state.json: %s", e)
         state = {}
 
 
-def save_state() -> None:
+_state_dirty = threading.Event()
+_journal_lock = threading.Lock()
+_journal_fd: Optional[int] = None
+
+
+def journal(op: str, chat_id: str, alloc: Dict[str, Any]) -> None:
+    """
+    Append one state change to state.log (a single O_APPEND write) instead of rewriting
+    state.json; the flusher folds the journal into a fresh snapshot periodically.
+    """
+    global _journal_fd
+    line = json_dumps({"op": op, "chat": chat_id, "alloc": alloc}) + b"\n"
+    with _journal_lock:
+        try:
+            if _journal_fd is None:
+                _journal_fd = os.open(STATE_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(_journal_fd, line)
+        except Exception as e:
+            logger.warning("Failed to append to %s: %s", STATE_LOG, e)
+    _state_dirty.set()
+
+
+def _rotate_journal() -> None:
+    """Move state.log aside as the old generation; the next journal() call starts a new one."""
+    global _journal_fd
+    if _journal_fd is not None:
+        os.close(_journal_fd)
+        _journal_fd = None
+    if not os.path.exists(STATE_LOG):
+        return
+    if os.path.exists(STATE_LOG_OLD):
+        # an earlier compaction failed before dropping it; keep both in replay order
+        with open(STATE_LOG, "rb") as src, open(STATE_LOG_OLD, "ab") as dst:
+            dst.write(src.read())
+        os.remove(STATE_LOG)
+    else:
+        os.replace(STATE_LOG, STATE_LOG_OLD)
+
+
+def flush_state() -> None:
+    """
+    Write a state.json snapshot (temp file + os.replace so a crash never leaves a partial
+    file) and drop the journal generation it now contains.
+    """
+    _state_dirty.clear()
     try:
-        with open(STATE_FILE, "w") as f:
-            json.dump(state, f)
+        # only the dump and the journal rename happen under the locks; changes made
+        # after this go to a fresh state.log, so the file write doesn't hold up mutators
+        with _state_lock, _journal_lock:
+            data = json_dumps(state)
+            _rotate_journal()
+        tmp = STATE_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            # the old journal is removed next, so the snapshot must be on disk first
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, STATE_FILE)
+        # make the rename itself durable before the journal it replaces goes away
+        fd = os.open(os.path.dirname(STATE_FILE) or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if os.path.exists(STATE_LOG_OLD):
+            os.remove(STATE_LOG_OLD)
     except Exception as e:
         logger.warning("Failed to save state.json: %s", e)
+        _state_dirty.set()  # the journal still has everything; retry on the next pass
+
+
+def state_flusher_loop() -> None:
+    while True:
+        _state_dirty.wait()
+        time.sleep(STATE_COMPACT_INTERVAL)  # changes are already durable in the journal
+        flush_state()
 
 # -----------------------------
 # Utilities
@@ -151,59 +375,125 @@ def save_state() -> None:
 def digits_only(s: Optional[str]) -> str:
     if not s:
         return ""
-    return re.sub(r"\D", "", str(s))
+    return _digits_only_str(str(s))
+
+
+@lru_cache(maxsize=8192)
+def _digits_only_str(s: str) -> str:
+    # translate() is a single C pass; non-ASCII input keeps the regex so unicode junk is still dropped
+    if s.isascii():
+        return s.translate(_KEEP_DIGITS)
+    return _NON_DIGIT.sub("", s)
 
 
 def flatten_values(x: Any) -> str:
-    if isinstance(x, dict):
-        parts: List[str] = []
-        for v in x.values():
-            parts.append(flatten_values(v))
-        return " ".join(p for p in parts if p)
-    if isinstance(x, list):
-        return " ".join(flatten_values(i) for i in x)
-    return str(x)
-
-
-def extract_message_text(entry: Dict[str, Any]) -> str:
-    for k in ("message", "sms", "msg", "text", "body", "sms_text", "content", "raw"):
+    """All leaf values of a nested dict/list as one space-joined string (single join, no recursion)."""
+    out: List[str] = []
+    stack = [x]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, dict):
+            stack.extend(reversed(list(v.values())))
+        elif isinstance(v, list):
+            stack.extend(reversed(v))
+        else:
+            sv = str(v)
+            if sv:
+                out.append(sv)
+    return " ".join(out)
+
+
+def _deep_search_message(obj: Any) -> str:
+    """First message-like field anywhere in obj, depth-first in key order (explicit stack)."""
+    if not isinstance(obj, (dict, list)):
+        return ""
+    stack = [iter(obj.items()) if isinstance(obj, dict) else ((None, i) for i in obj)]
+    while stack:
+        pair = next(stack[-1], None)
+        if pair is None:
+            stack.pop()
+            continue
+        kk, vv = pair
+        if kk is not None and isinstance(vv, (str, int, float)) and kk.lower() in _DEEP_MSG_KEYS:
+            if str(vv):
+                return str(vv)
+            # an empty message field ends the search of this container only
+            stack.pop()
+            continue
+        if isinstance(vv, dict):
+            stack.append(iter(vv.items()))
+        elif isinstance(vv, list):
+            stack.append((None, i) for i in vv)
+    return ""
+
+
+def extract_message_text(entry: Dict[str, Any]) -> Optional[str]:
+    """SMS text from the known message fields (or a nested one); None when the entry has none."""
+    for k in _KNOWN_MSG_KEYS:
         v = entry.get(k)
         if v:
             return flatten_values(v)
-    # deep search fallback
-    def search(obj):
-        if isinstance(obj, dict):
-            for kk, vv in obj.items():
-                if isinstance(vv, (str, int, float)) and kk.lower() in ("message", "sms", "msg", "text", "body", "content", "description"):
-                    return str(vv)
-                res = search(vv)
-                if res:
-                    return res
-        if isinstance(obj, list):
-            for i in obj:
-                res = search(i)
-                if res:
-                    return res
-        return ""
-    nested = search(entry)
-    if nested:
-        return nested
-    return flatten_values(entry)
+    return _deep_search_message(entry) or None
 
 
 def extract_otp_from_text(text: str) -> Optional[str]:
     if not text:
         return None
-    txt = re.sub(r"[|:]+", " ", text)
-    m = re.search(r"\b(\d{4,8})\b", txt)
+    m = _OTP_ANY.search(_SEP.sub(" ", text))
     if m:
-        return m.group(1)
-    m2 = re.search(r"[<#>]{1,3}\s*([0-9]{4,8})", txt)
-    if m2:
-        return m2.group(1)
+        return m.group("tag") or m.group("num")
     return None
 
 
+@lru_cache(maxsize=4096)
+def last_n_variants(digits: str) -> Tuple[str, ...]:
+    """Trailing-digit suffixes (>= MIN_MATCH_DIGITS long) used to match shortened provider numbers."""
+    return tuple(digits[-n:] for n in range(MIN_MATCH_DIGITS, len(digits)))
+
+
+def scan_message(text: str) -> Tuple[Optional[str], bool]:
+    """Single pass over an SMS: (first OTP like extract_otp_from_text, whether it mentions expired/failed)."""
+    if not text:
+        return None, False
+    otp: Optional[str] = None
+    expired = False
+    for m in _OTP_OR_EXPIRED.finditer(_SEP.sub(" ", text)):
+        if m.group("expired"):
+            expired = True
+        elif otp is None:
+            otp = m.group("tag") or m.group("num")
+        if otp is not None and expired:
+            break
+    return otp, expired
+
+
+_day_strings: Tuple[int, str, str] = (-1, "", "")
+
+
+def utc_day_strings() -> Tuple[str, str]:
+    """(today, yesterday) as YYYY-MM-DD in UTC; strftime only reruns when the day rolls over."""
+    global _day_strings
+    day = int(time.time() // 86400)
+    if _day_strings[0] != day:
+        today = datetime.fromtimestamp(day * 86400, tz=timezone.utc)
+        _day_strings = (day, today.strftime("%Y-%m-%d"), (today - timedelta(days=1)).strftime("%Y-%m-%d"))
+    return _day_strings[1], _day_strings[2]
+
+
+@lru_cache(maxsize=1024)
+def _utc_day_string(day: int) -> str:
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def utc_date_of(ts: Any) -> Optional[str]:
+    """YYYY-MM-DD (UTC) of a unix timestamp, formatted once per distinct day."""
+    try:
+        return _utc_day_string(int(ts) // 86400)
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=4096)
 def format_pretty_number(number: str) -> str:
     if not number:
         return ""
@@ -213,53 +503,92 @@ def format_pretty_number(number: str) -> str:
         plus = "+"
         s = s[1:]
     d = digits_only(s)
-    groups = []
-    while d:
-        groups.insert(0, d[-3:])
-        d = d[:-3]
+    # groups of 3 from the right: a short leading group, then fixed slices
+    head = len(d) % 3
+    groups = ([d[:head]] if head else []) + [d[i:i + 3] for i in range(head, len(d), 3)]
     return f"{plus}{' '.join(groups)}"
 
 # -----------------------------
 # Provider API helpers
 # -----------------------------
+# short-lived /info responses shared by the sweep and discovery: key = (date, page, status)
+_info_cache: Dict[Tuple[str, int, Optional[str]], Tuple[float, Dict[str, Any]]] = {}
+_info_cache_lock = threading.Lock()
+
+
 def fetch_info(date_str: str, page: int = 1, status: Optional[str] = None) -> Dict[str, Any]:
+    """GET /info; a response is reused for INFO_CACHE_TTL seconds by any caller asking for the same page."""
+    key = (date_str, page, status)
+    now = time.time()
+    with _info_cache_lock:
+        hit = _info_cache.get(key)
+    if hit and now - hit[0] < INFO_CACHE_TTL:
+        return hit[1]
     params = {"date": date_str, "page": page, "search": ""}
     if status:
         params["status"] = status
-    resp = requests.get(INFO_URL, headers=HEADERS, params=params, timeout=30)
+    resp = SESSION.get(INFO_URL, params=params, timeout=30)
     resp.raise_for_status()
-    return resp.json()
+    data = json_loads(resp.content)
+    with _info_cache_lock:
+        if len(_info_cache) >= 256:
+            for k in [k for k, (ts, _) in _info_cache.items() if now - ts >= INFO_CACHE_TTL]:
+                del _info_cache[k]
+        _info_cache[key] = (now, data)
+    return data
+
+
+# payload shapes tried for /allocate, in order; "range" is added per call
+_PAYLOAD_SHAPES: List[Dict[str, Any]] = [
+    {"is_national": None, "remove_plus": None},
+    {"is_national": False, "remove_plus": False},
+    {"is_national": True, "remove_plus": False},
+    {"is_national": False, "remove_plus": True},
+    {"is_national": True, "remove_plus": True},
+    {},
+]
+# index of the shape the provider last accepted; tried first on the next allocation
+_preferred_shape: Optional[int] = None
 
 
 def try_allocate_payload_variants(prefix: str, timeout: int = 25) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
     """
     Try several payload shapes; returns (json_response, error_message).
-    Many providers behave slightly differently; we attempt multiple combinations.
+    Many providers behave slightly differently; we attempt multiple combinations,
+    starting with the one that worked last time.
     """
-    payload_variants = [
-        {"range": prefix, "is_national": None, "remove_plus": None},
-        {"range": prefix, "is_national": False, "remove_plus": False},
-        {"range": prefix, "is_national": True, "remove_plus": False},
-        {"range": prefix, "is_national": False, "remove_plus": True},
-        {"range": prefix, "is_national": True, "remove_plus": True},
-        {"range": prefix},
-    ]
+    global _preferred_shape
+    preferred = _preferred_shape
+    order = list(range(len(_PAYLOAD_SHAPES)))
+    if preferred is not None:
+        order.remove(preferred)
+        order.insert(0, preferred)
     last_err = None
-    for p in payload_variants:
+    for idx in order:
+        p = {"range": prefix, **_PAYLOAD_SHAPES[idx]}
         try:
             logger.debug("Alloc try payload=%s", p)
-            r = requests.post(ALLOCATE_URL, json=p, headers=HEADERS, timeout=timeout)
+            r = SESSION.post(ALLOCATE_URL, json=p, timeout=timeout)
             body = r.text
             try:
-                j = r.json()
+                j = json_loads(r.content)
             except Exception:
                 j = {"http_status": r.status_code, "body": body}
             if 200 <= r.status_code < 300:
                 logger.info("Allocation success (payload=%s)", p)
+                _preferred_shape = idx
                 return j, None
             else:
                 logger.warning("Allocation returned HTTP %s payload=%s body=%s", r.status_code, p, body[:400])
                 last_err = f"HTTP {r.status_code}: {body[:300]}"
+                if r.status_code in (401, 403):
+                    # bad/blocked API key: no payload shape will change that
+                    break
+                rejected = r.status_code == 422 or (r.status_code == 400 and "no number found" not in body.lower())
+                if idx == preferred and rejected:
+                    # the provider stopped accepting this shape (not just out of numbers);
+                    # fall back to the default order
+                    _preferred_shape = None
         except Exception as e:
             logger.warning("Allocation exception payload=%s error=%s", p, e)
             last_err = str(e)
@@ -271,280 +600,458 @@ def try_allocate_payload_variants(prefix: str, timeout: int = 25) -> Tuple[Optio
 def service_in_text(service: str, text: str) -> bool:
     if not text:
         return False
-    t = text.lower()
-    s = service.lower()
-    mapping = {
-        "whatsapp": ["whatsapp", "wa"],
-        "instagram": ["instagram", "insta", "ig"],
-        "facebook": ["facebook", "fb"],
-        "other": [],
-    }
-    keys = mapping.get(s, [s])
-    for k in keys:
-        if k and k in t:
-            return True
-    # Other matches generic OTP mentions
-    if s == "other" and ("otp" in t or "code" in t):
-        return True
-    return False
+    pat = _SERVICE_PATTERNS.get(service.lower())
+    if pat is None:
+        return service.lower() in text.lower()
+    return pat.search(text) is not None
+
+
+def _fetch_discovery_page(date_str: str, page: int) -> Optional[Dict[str, Any]]:
+    """One discovery page: unfiltered first, status=success if that request fails."""
+    for status in (None, "success"):
+        try:
+            return fetch_info(date_str, page=page, status=status)
+        except Exception:
+            continue
+    return None
+
+
+_discover_cache: Dict[Tuple[str, int], Tuple[float, List[Tuple[str, str, int]]]] = {}
+_discover_cache_lock = threading.Lock()
+# one scan at a time per key; concurrent callers wait for it and reuse the result
+_discover_scan_locks: Dict[Tuple[str, int], threading.Lock] = {}
 
 
 def discover_country_prefixes_for_service(service: str, pages: int = DISCOVER_PAGES) -> List[Tuple[str, str, int]]:
     """
     Scan recent /info pages and return sorted list of (country, prefix, count).
     Prefer entries where the provider returns a non-empty country field.
+    Results are reused for DISCOVER_CACHE_TTL seconds (the country list and the
+    allocation step of one /get flow ask for the same scan).
     """
-    counts: Dict[Tuple[str, str], int] = {}
-    today = datetime.now(timezone.utc)
-    dates = [today.strftime("%Y-%m-%d"), (today - timedelta(days=1)).strftime("%Y-%m-%d")]
-    for date_str in dates:
-        for page in range(1, pages + 1):
-            try:
-                resp = fetch_info(date_str, page=page, status=None)
-            except Exception:
-                try:
-                    resp = fetch_info(date_str, page=page, status="success")
-                except Exception:
-                    continue
-            data = resp.get("data")
-            if not data:
+    key = (service, pages)
+    with _discover_cache_lock:
+        hit = _discover_cache.get(key)
+        if hit and time.time() - hit[0] < DISCOVER_CACHE_TTL:
+            return hit[1]
+        scan_lock = _discover_scan_locks.setdefault(key, threading.Lock())
+    with scan_lock:
+        # another caller may have completed the same scan while we waited
+        with _discover_cache_lock:
+            hit = _discover_cache.get(key)
+        if hit and time.time() - hit[0] < DISCOVER_CACHE_TTL:
+            return hit[1]
+        result = _scan_country_prefixes(service, pages)
+        with _discover_cache_lock:
+            _discover_cache[key] = (time.time(), result)
+    return result
+
+
+def _scan_country_prefixes(service: str, pages: int) -> List[Tuple[str, str, int]]:
+    counts: Counter = Counter()
+    jobs = [(date_str, page) for date_str in utc_day_strings() for page in range(1, pages + 1)]
+    # pages are fetched concurrently; counting below stays serial
+    for resp in HTTP_POOL.map(lambda job: _fetch_discovery_page(*job), jobs):
+        if not resp:
+            continue
+        data = resp.get("data")
+        if not data:
+            continue
+        entries = data if isinstance(data, list) else [data]
+        for e in entries:
+            country = e.get("country") or e.get("iso") or ""
+            if not country:
+                # skip unknown country entries for the country list step
                 continue
-            entries = data if isinstance(data, list) else [data]
-            for e in entries:
-                msg = extract_message_text(e) or ""
-                if not service_in_text(service, msg):
-                    continue
-                num = e.get("full_number") or e.get("number") or e.get("copy") or ""
-                if not num:
-                    flat = flatten_values(e)
-                    d = digits_only(flat)
-                    if len(d) >= 6:
-                        num = d
+            # flatten at most once per entry, shared by the text and number fallbacks
+            flat: Optional[str] = None
+            msg = extract_message_text(e)
+            if not msg:
+                flat = msg = flatten_values(e)
+            if not service_in_text(service, msg):
+                continue
+            num = e.get("full_number") or e.get("number") or e.get("copy") or ""
+            if num:
                 d = digits_only(num)
-                if len(d) < 6:
-                    continue
-                # pick prefix length 7 or 8 when possible
-                pref = d[:6]
-                if len(d) >= 8:
-                    pref = d[:8]
-                elif len(d) >= 7:
-                    pref = d[:7]
-                country = e.get("country") or e.get("iso") or ""
-                if not country:
-                    # skip unknown country entries for the country list step
-                    continue
-                key = (country, pref)
-                counts[key] = counts.get(key, 0) + 1
-    items = sorted(counts.items(), key=lambda kv: kv[1], reverse=True)
-    return [(country, pref, cnt) for ((country, pref), cnt) in items]
+            else:
+                d = digits_only(flat if flat is not None else flatten_values(e))
+            if len(d) < 6:
+                continue
+            # pick prefix length 7 or 8 when possible
+            pref = d[:6]
+            if len(d) >= 8:
+                pref = d[:8]
+            elif len(d) >= 7:
+                pref = d[:7]
+            counts[(country, pref)] += 1
+    return [(country, pref, cnt) for (country, pref), cnt in counts.most_common()]
 
 # -----------------------------
 # Allocation bookkeeping
 # -----------------------------
 def ensure_chat_allocations(chat_id: str) -> None:
-    if chat_id not in state:
-        state[chat_id] = {"allocations": [], "history": []}
+    with _state_lock:
+        if chat_id not in state:
+            state[chat_id] = {"allocations": {}, "history": deque(maxlen=HISTORY_LIMIT)}
 
 
 def add_allocation(chat_id: str, rng: str, full_number: str, country: str) -> str:
-    ensure_chat_allocations(chat_id)
-    alloc_id = str(int(time.time() * 1000)) + "_" + str(len(state[chat_id]["allocations"]))
     digits = digits_only(full_number)
-    entry = {
-        "id": alloc_id,
-        "range": rng,
-        "number": full_number,
-        "digits": digits,
-        "country": country,
-        "allocated_at": int(time.time()),
-        "status": "pending",
-        "otp": None,
-    }
-    state[chat_id]["allocations"].append(entry)
-    save_state()
+    with _state_lock:
+        ensure_chat_allocations(chat_id)
+        alloc_id = str(int(time.time() * 1000)) + "_" + str(len(state[chat_id]["allocations"]))
+        entry = {
+            "id": alloc_id,
+            "range": rng,
+            "number": full_number,
+            "digits": digits,
+            "last_variants": list(last_n_variants(digits)),
+            "country": country,
+            "allocated_at": int(time.time()),
+            "status": "pending",
+            "otp": None,
+        }
+        state[chat_id]["allocations"][alloc_id] = entry
+        journal("add", chat_id, entry)
+    index_allocation(chat_id, entry)
     return alloc_id
 
 
 def archive_allocation(chat_id: str, alloc: Dict[str, Any]) -> None:
-    """Move allocation to history archive (keeps last N if desired)"""
-    ensure_chat_allocations(chat_id)
-    history = state[chat_id].setdefault("history", [])
-    history.append(alloc)
-    # optionally limit history length
-    if len(history) > 200:
-        history.pop(0)
-    save_state()
+    """Append to the chat's history; the deque drops the oldest past HISTORY_LIMIT. Caller persists."""
+    with _state_lock:
+        ensure_chat_allocations(chat_id)
+        state[chat_id]["history"].append(alloc)
 
 
 def get_allocation(chat_id: str, alloc_id: str) -> Optional[Dict[str, Any]]:
-    arr = state.get(chat_id, {}).get("allocations", [])
-    for a in arr:
-        if a.get("id") == alloc_id:
-            return a
-    return None
+    chat = state.get(chat_id)
+    return chat["allocations"].get(alloc_id) if chat else None
 
 # -----------------------------
-# Polling job for each allocation
+# Shared polling sweep (one job for every pending allocation)
 # -----------------------------
-def polling_job_for_alloc(context: CallbackContext) -> None:
-    job_ctx = context.job.context
-    chat_id = str(job_ctx["chat_id"])
-    alloc_id = job_ctx["alloc_id"]
-    alloc = get_allocation(chat_id, alloc_id)
-    if not alloc:
-        # cleanup job
-        key = f"{chat_id}:{alloc_id}"
-        job_obj = jobs_registry.pop(key, None)
-        if job_obj:
-            try:
-                job_obj.schedule_removal()
-            except Exception:
-                pass
+# Inverted index of pending allocations, kept up to date on allocate/finish instead of
+# being rebuilt from state every sweep. Updates are copy-on-write under _index_lock, so
+# the sweep reads a consistent snapshot without locking:
+# - "by_digits": allocation digits -> [(chat_id, alloc)]
+# - "suffix":    last_variants -> allocation digits, for entries that only show a
+#                shortened/national form of the allocated number
+# - "automaton": Aho-Corasick automaton over all allocation digits (pyahocorasick, optional)
+_match_index: Dict[str, Any] = {"by_digits": {}, "suffix": {}, "automaton": None}
+_index_lock = threading.Lock()
+
+
+def _publish_index(by_digits: Dict[str, List[Tuple[str, Dict[str, Any]]]], suffix: Dict[str, Set[str]]) -> None:
+    global _match_index
+    automaton = None
+    if ahocorasick is not None and by_digits:
+        automaton = ahocorasick.Automaton()
+        for d in by_digits:
+            automaton.add_word(d, d)
+        automaton.make_automaton()
+    _match_index = {"by_digits": by_digits, "suffix": suffix, "automaton": automaton}
+
+
+def index_allocation(chat_id: str, alloc: Dict[str, Any]) -> None:
+    d = alloc.get("digits")
+    if not d:
         return
+    with _index_lock:
+        by_digits = dict(_match_index["by_digits"])
+        suffix = dict(_match_index["suffix"])
+        by_digits[d] = by_digits.get(d, []) + [(chat_id, alloc)]
+        for v in alloc.get("last_variants") or ():
+            suffix[v] = suffix.get(v, set()) | {d}
+        _publish_index(by_digits, suffix)
+
+
+def unindex_allocation(alloc: Dict[str, Any]) -> None:
+    d = alloc.get("digits")
+    with _index_lock:
+        if d not in _match_index["by_digits"]:
+            return
+        by_digits = dict(_match_index["by_digits"])
+        suffix = dict(_match_index["suffix"])
+        left = [(cid, a) for cid, a in by_digits[d] if a.get("id") != alloc.get("id")]
+        if left:
+            by_digits[d] = left
+        else:
+            del by_digits[d]
+            for v in alloc.get("last_variants") or ():
+                rest = suffix.get(v, set()) - {d}
+                if rest:
+                    suffix[v] = rest
+                else:
+                    suffix.pop(v, None)
+        _publish_index(by_digits, suffix)
+
+
+def rebuild_index() -> None:
+    """Index every pending allocation in state (used after loading state.json)."""
+    by_digits: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+    suffix: Dict[str, Set[str]] = {}
+    with _state_lock:
+        pending = [(chat_id, a) for chat_id, chat_data in state.items()
+                   for a in chat_data.get("allocations", {}).values()]
+    for chat_id, a in pending:
+        d = a.get("digits")
+        if a.get("status") != "pending" or a.get("otp") or not d:
+            continue
+        by_digits.setdefault(d, []).append((chat_id, a))
+        for v in a.get("last_variants") or ():
+            suffix.setdefault(v, set()).add(d)
+    with _index_lock:
+        _publish_index(by_digits, suffix)
+
+
+def pending_allocations() -> List[Tuple[str, Dict[str, Any]]]:
+    """All (chat_id, allocation) pairs still waiting for an OTP."""
+    return [pair for pairs in _match_index["by_digits"].values() for pair in pairs]
+
+
+def poll_dates(allocs: List[Tuple[str, Dict[str, Any]]]) -> List[str]:
+    """
+    Today plus every allocation day. Yesterday is only scanned while some allocation
+    has not been polled yet or is older than an hour (a fresh one cannot be listed there).
+    """
+    now = time.time()
+    today, yesterday = utc_day_strings()
+    dates = [today]
+    if any(not a.get("polled_at") or now - a.get("allocated_at", 0) > 3600 for _, a in allocs):
+        dates.append(yesterday)
+    for _, a in allocs:
+        allocated_at = a.get("allocated_at")
+        d = utc_date_of(allocated_at) if allocated_at else None
+        if d and d not in dates:
+            dates.append(d)
+    return dates
+
+
+def finish_allocation(chat_id: str, alloc: Dict[str, Any]) -> None:
+    """Remove a completed (success/expired) allocation from the active list and archive it."""
+    unindex_allocation(alloc)
+    try:
+        with _state_lock:
+            state[chat_id]["allocations"].pop(alloc.get("id"), None)
+            archive_allocation(chat_id, alloc)
+            journal("finish", chat_id, alloc)
+    except Exception:
+        logger.exception("Error archiving allocation")
 
-    number = alloc.get("number")
-    digits = alloc.get("digits")
-    logger.debug("Polling allocation %s for chat %s number %s", alloc_id, chat_id, number)
 
-    # dates to check: allocated day, today, yesterday
-    dates = []
-    allocated_at = alloc.get("allocated_at")
-    if allocated_at:
+MAX_RETRY_AFTER = 30  # seconds; longer flood-control waits are not worth blocking the sweep for
+
+
+def send_retrying(send: Callable[..., Any], **kwargs: Any) -> Any:
+    """Call a Bot send method; on flood control (RetryAfter) wait as Telegram asks and retry once."""
+    try:
+        return send(**kwargs)
+    except RetryAfter as e:
+        if e.retry_after > MAX_RETRY_AFTER:
+            raise
+        logger.info("Flood control: retrying send in %ss", e.retry_after)
+        time.sleep(e.retry_after)
+        return send(**kwargs)
+
+
+def deliver_otp(bot: Bot, chat_id: str, alloc: Dict[str, Any], otp: str, msg: str) -> None:
+    with _state_lock:
+        # check-and-set: an allocation that already got its OTP or expired is never re-sent
+        if alloc.get("status") != "pending" or alloc.get("otp"):
+            return
+        alloc["otp"] = otp
+        alloc["status"] = "success"
+    pretty = format_pretty_number(alloc.get("number"))
+    tnow = datetime.now().strftime("%I:%M %p")
+    head = (
+        f"{CARD_SEPARATOR}\n"
+        f"🔔 OTP Received\n"
+        f"{CARD_SEPARATOR}\n"
+        f"📩 Code: <code>{html.escape(str(otp))}</code>\n"
+        f"📞 Number: {pretty}\n"
+        f"🗺 Country: {alloc.get('country','Unknown')}\n"
+        f"⏰ Time: {tnow}\n"
+        f"{CARD_SEPARATOR}\n"
+        f"Message:\n"
+    )
+    # keep the card a single message: an oversized SMS body is cut rather than
+    # making Telegram reject the whole card (the code is already in the header)
+    # (Telegram counts UTF-16 code units; the <code> tags are not counted)
+    body = (msg or "").encode("utf-16-le")
+    room = 2 * (TELEGRAM_TEXT_LIMIT + len("<code></code>")) - len(head.encode("utf-16-le"))
+    if len(body) > room:
+        body = body[:room - 2] + "…".encode("utf-16-le")
+    card = head + html.escape(body.decode("utf-16-le", "ignore"))
+    # the card already carries the code and full message: one call per destination.
+    # The group gets a server-side copy of the user's message when that send worked.
+    sent = None
+    try:
+        sent = send_retrying(bot.send_message, chat_id=int(chat_id), text=card, parse_mode=ParseMode.HTML)
+    except Exception as se:
+        logger.warning("Failed to send OTP message to user: %s", se)
+    try:
+        if sent is not None:
+            send_retrying(bot.copy_message, chat_id=FORWARD_CHAT_ID, from_chat_id=int(chat_id), message_id=sent.message_id)
+        else:
+            send_retrying(bot.send_message, chat_id=FORWARD_CHAT_ID, text=card, parse_mode=ParseMode.HTML)
+    except Exception as fe:
+        logger.warning("Failed to forward OTP to group: %s", fe)
+    finish_allocation(chat_id, alloc)
+
+
+def notify_expired(bot: Bot, chat_id: str, alloc: Dict[str, Any]) -> None:
+    with _state_lock:
+        if alloc.get("status") != "pending":
+            return
+        alloc["status"] = "expired"
+    try:
+        send_retrying(bot.send_message, chat_id=int(chat_id), text=f"{CARD_SEPARATOR}\n❌ Expired by provider\n{CARD_SEPARATOR}\n{format_pretty_number(alloc.get('number'))}")
+    except Exception:
+        pass
+    finish_allocation(chat_id, alloc)
+
+
+def find_allocation_digits(index: Dict[str, Any], text_digits: str) -> Set[str]:
+    """Allocation digits occurring anywhere inside text_digits (single scan with Aho-Corasick)."""
+    if not text_digits:
+        return set()
+    automaton = index["automaton"]
+    if automaton is not None:
+        return {d for _, d in automaton.iter(text_digits)}
+    return {d for d in index["by_digits"] if d in text_digits}
+
+
+def fetch_info_pages(date_str: str, status: Optional[str], max_pages: int = 5) -> List[List[Dict[str, Any]]]:
+    """Walk /info pages for one (date, status) until an empty or short page; returns entries per page."""
+    pages: List[List[Dict[str, Any]]] = []
+    for page in range(1, max_pages + 1):
         try:
-            dt = datetime.fromtimestamp(int(allocated_at), tz=timezone.utc)
-            dates.append(dt.strftime("%Y-%m-%d"))
-        except Exception:
-            pass
-    today = datetime.now(timezone.utc)
-    dates.append(today.strftime("%Y-%m-%d"))
-    dates.append((today - timedelta(days=1)).strftime("%Y-%m-%d"))
-
-    for date_str in dates:
-        for status in (None, "success"):
-            for page in range(1, 6):
-                try:
-                    resp = fetch_info(date_str, page=page, status=status)
-                except Exception as e:
-                    logger.debug("fetch_info error: %s", e)
-                    continue
-                data = resp.get("data")
-                if not data:
-                    continue
-                entries = data if isinstance(data, list) else [data]
-                for e in entries:
-                    explicit = e.get("full_number") or e.get("number") or e.get("copy") or ""
-                    exp_digits = digits_only(explicit)
-                    matched = False
-                    if exp_digits and digits and (digits == exp_digits or digits in exp_digits or exp_digits in digits):
-                        matched = True
-                    if not matched:
-                        flat = flatten_values(e)
-                        if digits and digits in digits_only(flat):
-                            matched = True
-                    if not matched:
-                        continue
-
-                    msg = extract_message_text(e) or flatten_values(e)
-                    otp = extract_otp_from_text(msg) or extract_otp_from_text(flatten_values(e))
-                    status_field = (e.get("status") or "") or ""
-                    provider_says_expired = False
-                    if isinstance(status_field, str) and ("expired" in status_field.lower() or "failed" in status_field.lower()):
-                        provider_says_expired = True
-                    else:
-                        low = (msg or "").lower()
-                        if ("expired" in low or "failed" in low) and digits and digits in digits_only(msg):
-                            provider_says_expired = True
-
-                    if otp and not alloc.get("otp"):
-                        alloc["otp"] = otp
-                        alloc["status"] = "success"
-                        save_state()
-                        pretty = format_pretty_number(number)
-                        tnow = datetime.now().strftime("%I:%M %p")
-                        sms_text = html.escape(msg or "")
-                        card = (
-                            f"{CARD_SEPARATOR}\n"
-                            f"🔔 OTP Received\n"
-                            f"{CARD_SEPARATOR}\n"
-                            f"📩 Code: <code>{html.escape(str(otp))}</code>\n"
-                            f"📞 Number: {pretty}\n"
-                            f"🗺 Country: {alloc.get('country','Unknown')}\n"
-                            f"⏰ Time: {tnow}\n"
-                            f"{CARD_SEPARATOR}\n"
-                            f"Message:\n{sms_text}"
-                        )
-                        try:
-                            context.bot.send_message(chat_id=int(chat_id), text=card, parse_mode=ParseMode.HTML)
-                            if msg:
-                                context.bot.send_message(chat_id=int(chat_id), text=f"Full message:\n{msg}")
-                            context.bot.send_message(chat_id=int(chat_id), text=f"🔐 OTP: <code>{html.escape(str(otp))}</code>", parse_mode=ParseMode.HTML)
-                        except Exception as se:
-                            logger.warning("Failed to send OTP message to user: %s", se)
-                        try:
-                            context.bot.send_message(chat_id=FORWARD_CHAT_ID, text=card, parse_mode=ParseMode.HTML)
-                        except Exception as fe:
-                            logger.warning("Failed to forward OTP to group: %s", fe)
-                        # stop job and archive
-                        key = f"{chat_id}:{alloc_id}"
-                        job_obj = jobs_registry.pop(key, None)
-                        if job_obj:
-                            try:
-                                job_obj.schedule_removal()
-                            except Exception:
-                                pass
-                        # move to history
-                        try:
-                            # remove from allocations and put into history
-                            chat_allocs = state.get(chat_id, {}).get("allocations", [])
-                            state[chat_id]["allocations"] = [a for a in chat_allocs if a.get("id") != alloc_id]
-                            state[chat_id].setdefault("history", []).append(alloc)
-                            save_state()
-                        except Exception:
-                            logger.exception("Error archiving allocation")
-                        return
-
-                    if provider_says_expired:
-                        alloc["status"] = "expired"
-                        save_state()
-                        try:
-                            context.bot.send_message(chat_id=int(chat_id), text=f"{CARD_SEPARATOR}\n❌ Expired by provider\n{CARD_SEPARATOR}\n{format_pretty_number(number)}")
-                        except Exception:
-                            pass
-                        # stop job and move to history
-                        key = f"{chat_id}:{alloc_id}"
-                        job_obj = jobs_registry.pop(key, None)
-                        if job_obj:
-                            try:
-                                job_obj.schedule_removal()
-                            except Exception:
-                                pass
-                        try:
-                            chat_allocs = state.get(chat_id, {}).get("allocations", [])
-                            state[chat_id]["allocations"] = [a for a in chat_allocs if a.get("id") != alloc_id]
-                            state[chat_id].setdefault("history", []).append(alloc)
-                            save_state()
-                        except Exception:
-                            logger.exception("Error moving expired allocation to history")
-                        return
-    # nothing found this pass
+            resp = fetch_info(date_str, page=page, status=status)
+        except Exception as e:
+            logger.debug("fetch_info error: %s", e)
+            continue
+        data = resp.get("data")
+        if not data:
+            # pages are filled in order; an empty page means there is nothing further
+            break
+        entries = data if isinstance(data, list) else [data]
+        pages.append(entries)
+        meta = resp.get("meta") or {}
+        per_page = meta.get("per_page") if isinstance(meta, dict) else None
+        if isinstance(per_page, int) and len(entries) < per_page:
+            # short page: the provider has nothing beyond it
+            break
+    return pages
+
+
+def process_info_entry(bot: Bot, index: Dict[str, Any], e: Dict[str, Any], seen: Set[str]) -> None:
+    """Match one /info entry against the pending allocations and deliver OTP / expiry."""
+    explicit = e.get("full_number") or e.get("number") or e.get("copy") or ""
+    exp_digits = digits_only(explicit)
+    # only the explicit number fields are matched; the whole entry is
+    # flattened lazily, and only for a matched entry without usable text
+    hits = find_allocation_digits(index, exp_digits)
+    hits |= index["suffix"].get(exp_digits, set())
+    if not hits:
+        return
+    flat: Optional[str] = None
+    msg = extract_message_text(e)
+    if not msg:
+        flat = msg = flatten_values(e)
+    otp, msg_expired = scan_message(msg)
+    if not otp:
+        if flat is None:
+            flat = flatten_values(e)
+        otp = extract_otp_from_text(flat)
+    # expiry keywords are checked once per entry; the message only counts when it names the number
+    status_field = e.get("status") or ""
+    status_expired = isinstance(status_field, str) and any(k in status_field.lower() for k in _EXPIRED_KEYS)
+    msg_digits = digits_only(msg) if msg_expired and not status_expired else ""
+    for digits in hits:
+        for cid, alloc in index["by_digits"][digits]:
+            if alloc.get("status") != "pending":
+                continue
+            seen.add(alloc.get("id"))
+
+            provider_says_expired = status_expired or (bool(msg_digits) and digits in msg_digits)
+            if otp and not alloc.get("otp"):
+                deliver_otp(bot, cid, alloc, otp, msg)
+            elif provider_says_expired:
+                notify_expired(bot, cid, alloc)
+
+
+def sweep_allocations(context: CallbackContext) -> None:
+    """
+    Single repeating job: fetch each (date, status, page) of /info once per tick and
+    match the returned entries against every due allocation of every chat.
+    The (date, status) page walks run concurrently on HTTP_POOL; matching stays on this thread.
+    """
+    index = _match_index
+    if not index["by_digits"]:
+        return
+    now = time.time()
+    # idle backoff: the sweep only runs once some allocation is due; any pending
+    # allocation that shows up in the fetched pages is still handled
+    due = [(cid, a) for cid, a in pending_allocations() if now >= a.get("next_poll_at", 0)]
+    if not due:
+        return
+    seen: Set[str] = set()
+
+    streams = [(date_str, status) for date_str in poll_dates(due) for status in (None, "success")]
+    for pages in HTTP_POOL.map(lambda ds: fetch_info_pages(*ds), streams):
+        for entries in pages:
+            for e in entries:
+                process_info_entry(context.bot, index, e, seen)
+        if not _match_index["by_digits"]:
+            break
+
+    # nothing conclusive this pass: back off (with jitter) unless the provider already lists the number
+    polled_at = int(time.time())
+    with _state_lock:
+        for _, alloc in due:
+            if alloc.get("status") != "pending":
+                continue
+            alloc["polled_at"] = polled_at
+            if alloc.get("id") in seen:
+                alloc["poll_attempts"] = 0
+                alloc.pop("next_poll_at", None)
+                continue
+            attempts = alloc.get("poll_attempts", 0) + 1
+            alloc["poll_attempts"] = attempts
+            delay = min(MAX_POLL_INTERVAL, POLL_INTERVAL * 2 ** min(attempts, 5) * random.uniform(0.5, 1.5))
+            alloc["next_poll_at"] = time.time() + delay
+    # backoff fields aren't journaled; they go out with the next snapshot
+    _state_dirty.set()
 
 # -----------------------------
 # Telegram command handlers
 # -----------------------------
 def start_command(update: Update, context: CallbackContext) -> None:
     try:
-        rk = ReplyKeyboardMarkup(MAIN_REPLY_KEYS, resize_keyboard=True, one_time_keyboard=False)
-        update.message.reply_text("👋 Welcome! " + MSG_HELPER, reply_markup=rk)
+        update.message.reply_text("👋 Welcome! " + MSG_HELPER, reply_markup=MAIN_REPLY_MARKUP)
     except Exception:
         update.message.reply_text("👋 Welcome! " + MSG_HELPER)
 
 
 def get_command(update: Update, context: CallbackContext) -> None:
-    kb = []
-    for svc in SERVICES:
-        kb.append([InlineKeyboardButton(svc, callback_data=f"svc|{svc}")])
-    kb.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
-    update.message.reply_text("Select Service:", reply_markup=InlineKeyboardMarkup(kb))
+    update.message.reply_text("Select Service:", reply_markup=SERVICE_MARKUP)
+
+
+@lru_cache(maxsize=len(SERVICES))
+def any_country_markup(svc: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Any country (try global prefixes)", callback_data=f"country|{svc}|__ANY__")],
+        [InlineKeyboardButton("Cancel", callback_data="cancel")],
+    ])
+
+
+def group_prefixes(svc: str, candidates: List[Tuple[str, str, int]]) -> Dict[str, Any]:
+    """Discovery result grouped for the country step: prefixes per country and overall, best first."""
+    by_country: Dict[str, List[str]] = {}
+    for country, pref, _ in candidates:
+        by_country.setdefault(country, []).append(pref)
+    return {"svc": svc, "by_country": by_country, "global": [pref for _, pref, _ in candidates]}
 
 
 def discover_and_send_countries(chat_id: int, svc: str, context: CallbackContext) -> None:
@@ -558,19 +1065,19 @@ def discover_and_send_countries(chat_id: int, svc: str, context: CallbackContext
         logger.exception("Discovery error: %s", e)
         context.bot.send_message(chat_id=chat_id, text=f"Discovery failed: {e}")
         return
+    # the country buttons below are built from this scan; the country callback reuses it
+    context.user_data["last_discover"] = group_prefixes(svc, candidates)
     # Build country counts (already provided by discover function) — keep only non-empty countries
-    by_country: Dict[str, int] = {}
+    by_country: Counter = Counter()
     for country, pref, cnt in candidates:
         if not country or country.strip() == "":
             continue
-        by_country[country] = by_country.get(country, 0) + cnt
+        by_country[country] += cnt
     if not by_country:
         # fallback: allow "Any country" option that will try global prefixes
-        kb = [[InlineKeyboardButton("Any country (try global prefixes)", callback_data=f"country|{svc}|__ANY__")],
-              [InlineKeyboardButton("Cancel", callback_data="cancel")]]
-        context.bot.send_message(chat_id=chat_id, text=f"No active countries found for {svc}. You may try global prefixes.", reply_markup=InlineKeyboardMarkup(kb))
+        context.bot.send_message(chat_id=chat_id, text=f"No active countries found for {svc}. You may try global prefixes.", reply_markup=any_country_markup(svc))
         return
-    sorted_countries = sorted(by_country.items(), key=lambda kv: kv[1], reverse=True)[:8]
+    sorted_countries = by_country.most_common(8)
     kb = []
     text = f"Select Country for {svc}:"
     for country, cnt in sorted_countries:
@@ -589,7 +1096,8 @@ def callback_query_handler(update: Update, context: CallbackContext) -> None:
         svc = svc.strip()
         query.answer()
         query.edit_message_text(f"Scanning for active countries for {svc} — please wait...")
-        threading.Thread(target=discover_and_send_countries, args=(chat_id, svc, context), daemon=True).start()
+        # already on a run_async worker, off the dispatcher thread
+        discover_and_send_countries(chat_id, svc, context)
         return
 
     if data.startswith("country|"):
@@ -604,11 +1112,12 @@ def callback_query_handler(update: Update, context: CallbackContext) -> None:
         country = country.strip()
         query.answer()
         query.edit_message_text(f"Allocating up to {MAX_ALLOC_PER_COUNTRY} numbers for {svc} • {country} — please wait...")
-        # Discover prefixes (including global fallback)
-        candidates = discover_country_prefixes_for_service(svc, pages=DISCOVER_PAGES)
-        # Build list of candidate prefixes for the chosen country
-        prefs_for_country: List[str] = [pref for (c, pref, cnt) in candidates if c == country]
-        prefs_global: List[str] = [pref for (c, pref, cnt) in candidates]
+        # Prefixes from the scan that produced these buttons; rescan only if it is gone
+        last = context.user_data.get("last_discover")
+        if not last or last.get("svc") != svc:
+            last = group_prefixes(svc, discover_country_prefixes_for_service(svc, pages=DISCOVER_PAGES))
+        prefs_for_country: List[str] = last["by_country"].get(country, [])
+        prefs_global: List[str] = last["global"]
         chosen_prefixes: List[str] = []
         # If user asked for __ANY__, we will use top global prefixes
         if country == "__ANY__":
@@ -631,9 +1140,9 @@ def callback_query_handler(update: Update, context: CallbackContext) -> None:
                     if len(chosen_prefixes) >= MAX_ALLOC_PER_COUNTRY:
                         break
         allocated_infos: List[Dict[str, Any]] = []
-        for pref in chosen_prefixes:
-            rng = pref + "XXX"
-            resp_json, err = try_allocate_payload_variants(rng)
+        # the provider calls run in parallel; bookkeeping below stays on this thread
+        ranges = [pref + "XXX" for pref in chosen_prefixes]
+        for rng, (resp_json, err) in zip(ranges, HTTP_POOL.map(try_allocate_payload_variants, ranges)):
             if resp_json is None:
                 allocated_infos.append({"range": rng, "error": err or "No response"})
                 continue
@@ -647,10 +1156,8 @@ def callback_query_handler(update: Update, context: CallbackContext) -> None:
             if not full_number:
                 allocated_infos.append({"range": rng, "error": "provider returned no number"})
                 continue
+            # picked up by the shared sweep job on its next tick
             alloc_id = add_allocation(str(chat_id), rng, full_number, country_name)
-            # start per-allocation polling job
-            job = context.job_queue.run_repeating(polling_job_for_alloc, interval=POLL_INTERVAL, first=5, context={"chat_id": int(chat_id), "alloc_id": alloc_id})
-            jobs_registry[f"{chat_id}:{alloc_id}"] = job
             allocated_infos.append({"range": rng, "number": full_number, "alloc_id": alloc_id, "country": country_name})
         # Build reply summary
         lines = []
@@ -718,59 +1225,95 @@ def text_message_handler(update: Update, context: CallbackContext) -> None:
 # -----------------------------
 def status_handler(update: Update, context: CallbackContext) -> None:
     chat_id = str(update.effective_chat.id)
-    allocations = state.get(chat_id, {}).get("allocations", [])
+    # copy: the sweep thread may finish allocations while we iterate
+    with _state_lock:
+        chat = state.get(chat_id)
+        allocations = list(chat["allocations"].values()) if chat else []
     # active = pending allocations (no OTP, not expired)
     active = [a for a in allocations if a.get("status") == "pending" and not a.get("otp")]
     if not active:
         update.message.reply_text("No active numbers. Use /get.")
         return
-    lines = []
-    kb = []
-    for a in active:
-        pretty = format_pretty_number(a.get("number"))
-        lines.append(f"{pretty} • {a.get('country')}")
-        kb.append([InlineKeyboardButton(pretty, callback_data=f"noop|{a.get('id')}")])
-    update.message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb))
+    pretties = [format_pretty_number(a.get("number")) for a in active]
+    text = "\n".join(f"{p} • {a.get('country')}" for p, a in zip(pretties, active))
+    kb = [[InlineKeyboardButton(p, callback_data=f"noop|{a.get('id')}")] for p, a in zip(pretties, active)]
+    update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+
+# chat_id -> (id of the newest history entry, rendered /history text); history is
+# append-only, so a new newest entry is the only thing that changes the text
+_history_text: Dict[str, Tuple[Any, str]] = {}
 
 
 def history_handler(update: Update, context: CallbackContext) -> None:
     chat_id = str(update.effective_chat.id)
-    hist = state.get(chat_id, {}).get("history", [])
+    with _state_lock:
+        chat = state.get(chat_id)
+        hist = chat["history"] if chat else ()
+        if not hist:
+            recent = None
+        else:
+            newest = hist[-1].get("id")
+            cached = _history_text.get(chat_id)
+            recent = None if cached and cached[0] == newest else list(islice(reversed(hist), 20))
     if not hist:
         update.message.reply_text("No history available yet.")
         return
-    lines = []
-    for h in reversed(hist[-20:]):
-        pretty = format_pretty_number(h.get("number"))
-        status = h.get("status", "unknown")
-        otp = h.get("otp") or ""
-        line = f"{pretty} • {h.get('country')} • {status}"
-        if otp:
-            line += f" • OTP: {otp}"
-        lines.append(line)
-    update.message.reply_text("\n".join(lines))
+    if recent is None:
+        update.message.reply_text(cached[1])
+        return
+    text = "\n".join(
+        f"{format_pretty_number(h.get('number'))} • {h.get('country')} • {h.get('status', 'unknown')}"
+        + (f" • OTP: {h['otp']}" if h.get("otp") else "")
+        for h in recent
+    )
+    _history_text[chat_id] = (newest, text)
+    update.message.reply_text(text)
 
 
 def settings_handler(update: Update, context: CallbackContext) -> None:
     # simple settings placeholder; you can expand
-    text = (
-        "Settings:\n"
-        f"- Poll interval: {POLL_INTERVAL}s\n"
-        f"- Discover pages: {DISCOVER_PAGES}\n"
-        f"- Max alloc per country: {MAX_ALLOC_PER_COUNTRY}\n\n"
-        "Use environment variables to change settings and restart the service."
-    )
-    update.message.reply_text(text)
+    update.message.reply_text(SETTINGS_TEXT)
 
 # -----------------------------
 # Token watcher & updater (dynamic)
 # -----------------------------
 _updater_global: Optional[Updater] = None
+_stop = threading.Event()  # set on SIGTERM/SIGINT; background loops wait on it
 _updater_lock = threading.Lock()
+# one Bot (and connection pool) per token, reused by the watcher and /checktoken
+_bot_cache: Dict[str, Bot] = {}
+# own lock: _updater_lock is held across Updater.stop(), which joins the run_async
+# workers that /checktoken runs on
+_bot_cache_lock = threading.Lock()
+# token -> (checked_at, get_me() result); /checktoken answers from here for a minute
+_me_cache: Dict[str, Tuple[float, Any]] = {}
+ME_CACHE_TTL = 60
+
+
+def get_bot(token: str) -> Bot:
+    with _bot_cache_lock:
+        bot = _bot_cache.get(token)
+        if bot is None:
+            # the Updater's 4 workers + polling need more than Bot's default single connection
+            bot = _bot_cache[token] = Bot(token, request=Request(con_pool_size=8))
+        return bot
+
+
+def get_me_cached(token: str) -> Any:
+    hit = _me_cache.get(token)
+    if hit and time.time() - hit[0] < ME_CACHE_TTL:
+        return hit[1]
+    me = get_bot(token).get_me()
+    _me_cache[token] = (time.time(), me)
+    return me
 
 
 def start_telegram_updater(bot: Bot) -> None:
     global _updater_global
+    if _updater_global:
+        # already running: no need to contend for the lock
+        return
     with _updater_lock:
         if _updater_global:
             return
@@ -782,64 +1325,96 @@ def start_telegram_updater(bot: Bot) -> None:
         dp.add_handler(CommandHandler("status", status_handler))
         dp.add_handler(CommandHandler("history", history_handler))
         dp.add_handler(CommandHandler("settings", settings_handler))
-        dp.add_handler(CommandHandler("checktoken", checktoken_command))
-        dp.add_handler(CallbackQueryHandler(callback_query_handler))
+        # discovery/allocation and token checks call out over HTTP; run them on the
+        # dispatcher's worker pool so one slow provider call doesn't stall every other update
+        dp.add_handler(CommandHandler("checktoken", checktoken_command, run_async=True))
+        dp.add_handler(CallbackQueryHandler(callback_query_handler, run_async=True))
         # map bottom keyboard text to actions
         dp.add_handler(MessageHandler(Filters.text & (~Filters.command), text_message_handler))
         try:
-            updater.start_polling()
-            logger.info("Telegram updater started.")
+            if WEBHOOK_URL:
+                # Telegram pushes each update; the secret token path keeps the endpoint private
+                updater.start_webhook(
+                    listen="0.0.0.0",
+                    port=PORT,
+                    url_path=bot.token,
+                    webhook_url=f"{WEBHOOK_URL}/{bot.token}",
+                    bootstrap_retries=-1,
+                    allowed_updates=["message", "callback_query"],
+                )
+            else:
+                # long polling: getUpdates waits up to 50s server-side instead of re-asking every few
+                # seconds; only the update types we have handlers for are delivered
+                updater.start_polling(
+                    poll_interval=0.0,
+                    timeout=50,
+                    read_latency=2.0,
+                    bootstrap_retries=-1,
+                    allowed_updates=["message", "callback_query"],
+                )
+            logger.info("Telegram updater started (%s).", "webhook" if WEBHOOK_URL else "polling")
             _updater_global = updater
-            # restart jobs for saved allocations
-            for chat_id, chat_data in state.items():
-                for alloc in chat_data.get("allocations", []):
-                    if alloc.get("status") != "expired" and not alloc.get("otp"):
-                        job = updater.job_queue.run_repeating(polling_job_for_alloc, interval=POLL_INTERVAL, first=5, context={"chat_id": int(chat_id), "alloc_id": alloc.get("id")})
-                        jobs_registry[f"{chat_id}:{alloc.get('id')}"] = job
+            # one sweep covers saved and future allocations alike
+            updater.job_queue.run_repeating(sweep_allocations, interval=POLL_INTERVAL, first=5, name="sweep_allocations")
         except Conflict:
             logger.error("Conflict: another getUpdates running")
         except Unauthorized:
             logger.error("Unauthorized when starting updater")
 
 
+TOKEN_RETRY_CAP = 60  # seconds; upper bound for the token watcher's retry backoff
+
+
+def _token_retry_delay(base: float, attempt: int) -> float:
+    """Exponential backoff from base, capped at TOKEN_RETRY_CAP, plus up to 1s of jitter."""
+    return min(TOKEN_RETRY_CAP, base * 2 ** min(attempt, 6)) + random.random()
+
+
 def token_watcher_loop() -> None:
     """
     Repeatedly re-reads BOT_TOKEN from environment so you can change it in the host UI
     without immediate redeploy. Starts the updater when BOT_TOKEN is valid.
+    Waits on the shutdown event, so a stop request ends it immediately.
     """
     last_token = ""
-    while True:
+    attempt = 0
+    while not _stop.is_set():
         token = os.getenv("BOT_TOKEN", "").strip()
         if not token:
             logger.warning("BOT_TOKEN missing in environment. Waiting 10s.")
-            time.sleep(10)
+            if _stop.wait(10):
+                return
             continue
         if token != last_token:
             logger.info("BOT_TOKEN loaded/changed.")
             last_token = token
+            attempt = 0
         try:
-            bot = Bot(token)
-            me = bot.get_me()
+            bot = get_bot(token)
+            me = get_me_cached(token)
             logger.info("Validated bot: %s (id=%s)", getattr(me, "username", ""), getattr(me, "id", ""))
-            try:
-                bot.delete_webhook()
-                logger.info("Deleted webhook to enable polling.")
-            except Exception:
-                pass
+            if not WEBHOOK_URL:
+                try:
+                    bot.delete_webhook()
+                    logger.info("Deleted webhook to enable polling.")
+                except Exception:
+                    pass
             start_telegram_updater(bot)
             return
         except Unauthorized:
-            logger.error("BOT_TOKEN invalid/unauthorized. Will retry in 20s.")
-            time.sleep(20)
-            continue
+            delay = _token_retry_delay(20, attempt)
+            if attempt == 0 or delay >= TOKEN_RETRY_CAP and attempt % 10 == 0:
+                # once per token, then every tenth capped retry
+                logger.error("BOT_TOKEN invalid/unauthorized. Will retry in %.0fs.", delay)
         except NetworkError as ne:
-            logger.warning("Network error validating token: %s — retrying in 5s", ne)
-            time.sleep(5)
-            continue
+            delay = _token_retry_delay(5, attempt)
+            logger.warning("Network error validating token: %s — retrying in %.0fs", ne, delay)
         except Exception as e:
-            logger.warning("Token watcher unexpected error: %s — retrying", e)
-            time.sleep(10)
-            continue
+            delay = _token_retry_delay(10, attempt)
+            logger.warning("Token watcher unexpected error: %s — retrying in %.0fs", e, delay)
+        attempt += 1
+        if _stop.wait(delay):
+            return
 
 
 def checktoken_command(update: Update, context: CallbackContext) -> None:
@@ -852,8 +1427,7 @@ def checktoken_command(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("BOT_TOKEN not set in environment.")
         return
     try:
-        b = Bot(token)
-        me = b.get_me()
+        me = get_me_cached(token)
         update.message.reply_text(f"Token OK. Bot: @{getattr(me,'username','')}, id={getattr(me,'id','')}")
     except Exception as e:
         update.message.reply_text(f"Token test failed: {type(e).__name__}: {e}")
@@ -861,20 +1435,27 @@ def checktoken_command(update: Update, context: CallbackContext) -> None:
 # -----------------------------
 # Main entry
 # -----------------------------
+def _request_stop(signum: int, frame: Any) -> None:
+    logger.info("Shutdown requested (signal %s).", signum)
+    _stop.set()
+
+
 def main() -> None:
     # sanity checks
     if not MNIT_API_KEY:
         logger.error("MNIT_API_KEY not set. Set environment variable and restart.")
     load_state()
+    rebuild_index()
+    threading.Thread(target=state_flusher_loop, daemon=True).start()
     # start token watcher thread to start updater when BOT_TOKEN valid
     t = threading.Thread(target=token_watcher_loop, daemon=True)
     t.start()
     logger.info("Service running; Telegram updater will start when BOT_TOKEN is valid.")
-    try:
-        while True:
-            time.sleep(60)
-    except KeyboardInterrupt:
-        logger.info("Shutdown requested.")
+    # hosts stop the service with SIGTERM, Ctrl+C sends SIGINT; both wake the wait
+    # below at once and take the graceful path so the pending snapshot is flushed
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+    _stop.wait()
     # graceful stop
     global _updater_global
     with _updater_lock:
@@ -883,6 +1464,10 @@ def main() -> None:
                 _updater_global.stop()
             except Exception:
                 pass
+    if _state_dirty.is_set():
+        flush_state()
+    HTTP_POOL.shutdown(wait=False)
+    SESSION.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file